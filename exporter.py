@@ -1,10 +1,13 @@
-import json
+import asyncio
+import contextlib
+import functools
 import logging
 import os
-import re
 import sys
 
-import requests
+import aiofiles
+import aiohttp
+import orjson
 
 from config import (
     ARCHIVE_PAGE_TITLES,
@@ -47,55 +50,174 @@ def setup_logging():
 # Shared HTTP session
 # ---------------------------------------------------------------------------
 
-def make_session() -> requests.Session:
-    session = requests.Session()
-    session.headers.update({"Authorization": f"Bearer {BEARER_TOKEN}"})
-    return session
+# Connection pool shared by every phase of the export. All API calls go to
+# the same host, so the per-host cap is the effective one; pages in flight
+# are capped to match so each has a connection available.
+MAX_CONNECTIONS = 64
+MAX_CONNECTIONS_PER_HOST = 32
+MAX_CONCURRENT_PAGES = MAX_CONNECTIONS_PER_HOST
+
+# Transient gateway errors and dropped connections are retried with
+# exponential backoff (0.5s, 1s, 2s, ...)
+MAX_RETRIES = 5
+RETRY_BACKOFF = 0.5
+_RETRY_STATUSES = frozenset({502, 503, 504})
+
+
+def make_session() -> aiohttp.ClientSession:
+    """Create the shared HTTP session. Must be called from inside the event loop."""
+    connector = aiohttp.TCPConnector(
+        limit=MAX_CONNECTIONS,
+        limit_per_host=MAX_CONNECTIONS_PER_HOST,
+        ttl_dns_cache=300,
+    )
+    # Per-socket timeouts mirror requests' connect/read semantics; a total
+    # timeout would abort long attachment downloads.
+    timeout = aiohttp.ClientTimeout(sock_connect=REQUEST_TIMEOUT, sock_read=REQUEST_TIMEOUT)
+    return aiohttp.ClientSession(
+        headers={"Authorization": f"Bearer {BEARER_TOKEN}"},
+        connector=connector,
+        timeout=timeout,
+    )
+
+
+@contextlib.asynccontextmanager
+async def _get(session: aiohttp.ClientSession, url: str, **kwargs):
+    """session.get() that retries transient failures before yielding the response."""
+    for attempt in range(MAX_RETRIES + 1):
+        last_attempt = attempt == MAX_RETRIES
+        try:
+            resp = await session.get(url, **kwargs)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as exc:
+            if last_attempt:
+                raise
+            reason = f"{type(exc).__name__}: {exc}"
+        else:
+            if resp.status not in _RETRY_STATUSES or last_attempt:
+                break
+            reason = f"HTTP {resp.status}"
+            resp.release()
+
+        delay = RETRY_BACKOFF * 2 ** attempt
+        logging.debug("Retrying %s in %.1fs (%s)", url, delay, reason)
+        await asyncio.sleep(delay)
+
+    try:
+        yield resp
+    finally:
+        resp.release()
 
 # ---------------------------------------------------------------------------
 # Progress tracking
 # ---------------------------------------------------------------------------
 
 PROGRESS_FILE = os.path.join(EXPORT_DIR, "progress.json")
+# Append-only log of per-page outcomes since the last snapshot. Appending one
+# line per page keeps progress I/O linear; the log is folded back into
+# PROGRESS_FILE by compact_progress() at exit.
+PROGRESS_LOG = os.path.join(EXPORT_DIR, "progress.log")
 
 
 def load_progress() -> dict:
-    if not os.path.exists(PROGRESS_FILE):
-        return {"completed": set(), "failed": {}}
-    with open(PROGRESS_FILE, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    return {
-        "completed": set(data.get("completed", [])),
-        "failed": data.get("failed", {}),
-    }
+    """Load the last snapshot, then replay any log entries written after it."""
+    progress = {"completed": set(), "failed": {}, "validators": {}}
+    if os.path.exists(PROGRESS_FILE):
+        with open(PROGRESS_FILE, "rb") as f:
+            data = orjson.loads(f.read())
+        progress["completed"].update(data.get("completed", []))
+        progress["failed"].update(data.get("failed", {}))
+        progress["validators"].update(data.get("validators", {}))
+
+    if os.path.exists(PROGRESS_LOG):
+        with open(PROGRESS_LOG, "rb") as f:
+            for line in f:
+                try:
+                    record = orjson.loads(line)
+                except ValueError:
+                    # A line cut short by a crash; the page is simply redone
+                    logging.warning("Ignoring malformed progress log line: %r", line)
+                    continue
+                page_id = record["id"]
+                if record["status"] == "ok":
+                    progress["completed"].add(page_id)
+                    progress["failed"].pop(page_id, None)
+                    progress["validators"].update(record.get("validators", {}))
+                else:
+                    progress["completed"].discard(page_id)
+                    progress["failed"][page_id] = record.get("msg", "")
+    return progress
+
+
+def _fsync_and_close(fd: int):
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
 
+async def save_progress(progress: dict, page_id: str, validators: dict = None):
+    """Append the current outcome of page_id to the progress log.
 
-def save_progress(progress: dict):
+    validators holds the cache validators recorded for the page and its
+    attachments during this export, keyed by content ID.
+    """
+    if page_id in progress["completed"]:
+        record = {"id": page_id, "status": "ok"}
+        if validators:
+            record["validators"] = validators
+    else:
+        record = {"id": page_id, "status": "fail", "msg": progress["failed"].get(page_id, "")}
+    with open(PROGRESS_LOG, "ab") as f:
+        f.write(orjson.dumps(record) + b"\n")
+        f.flush()
+        fd = os.dup(f.fileno())
+    # The append itself stays on the loop so concurrent pages never
+    # interleave lines; only the slow fsync is handed to a thread, which owns
+    # a duplicate descriptor. The executor future is shielded rather than
+    # wrapped in to_thread, so cancelling this task (e.g. on Ctrl+C) neither
+    # closes the descriptor mid-fsync nor drops a queued job and leaks it.
+    loop = asyncio.get_running_loop()
+    await asyncio.shield(loop.run_in_executor(None, _fsync_and_close, fd))
+
+
+def compact_progress(progress: dict):
+    """Write a full snapshot to PROGRESS_FILE and discard the replayed log."""
     data = {
         "completed": sorted(progress["completed"]),
         "failed": progress["failed"],
+        "validators": progress["validators"],
     }
     # Write to a temp file first, then rename for atomicity
     tmp = PROGRESS_FILE + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
+    with open(tmp, "wb") as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS))
     os.replace(tmp, PROGRESS_FILE)
+    # Replaying the log over the new snapshot is idempotent, so a crash
+    # between the rename and the removal loses nothing.
+    if os.path.exists(PROGRESS_LOG):
+        os.remove(PROGRESS_LOG)
 
 # ---------------------------------------------------------------------------
 # Filesystem helpers
 # ---------------------------------------------------------------------------
 
-_UNSAFE_CHARS = re.compile(r'[<>:"/\\|?*\x00-\x1f]')
+# Maps each filesystem-unsafe character (including control chars) to "_"
+_UNSAFE_TABLE = str.maketrans({c: "_" for c in '<>:"/\\|?*' + "".join(chr(i) for i in range(32))})
 
 
 def safe_name(title: str) -> str:
-    sanitized = _UNSAFE_CHARS.sub("_", title).strip(". ")
+    sanitized = title.translate(_UNSAFE_TABLE).strip(". ")
     return sanitized[:80]  # cap length to avoid OS path-length issues
 
 # ---------------------------------------------------------------------------
 # Hierarchy path builder
 # ---------------------------------------------------------------------------
 
+# Extended-length prefix bypasses the Windows 260-char MAX_PATH limit; other
+# platforms have no such limit and would treat it as a literal directory name.
+_WIN_PREFIX = "\\\\?\\" if sys.platform == "win32" else ""
+
+
 def build_page_paths(pages: list) -> dict:
     """Return a dict mapping page_id → absolute export directory path.
 
@@ -110,8 +232,9 @@ def build_page_paths(pages: list) -> dict:
     and finally fall back to the ancestor ID to avoid dropping path segments.
     """
     id_to_title = {p["id"]: p["title"] for p in pages}
-    # Extended-length prefix bypasses Windows 260-char MAX_PATH limit
-    base = "\\\\?\\" + os.path.abspath(EXPORT_DIR)
+    base = _WIN_PREFIX + os.path.abspath(EXPORT_DIR)
+    # The same ancestor titles recur for every page beneath them
+    page_name = functools.lru_cache(maxsize=None)(safe_name)
     id_to_path = {}
     for page in pages:
         parts = []
@@ -123,8 +246,8 @@ def build_page_paths(pages: list) -> dict:
                 or ancestor_id
             )
             if title:
-                parts.append(safe_name(title))
-        parts.append(safe_name(page["title"]))
+                parts.append(page_name(title))
+        parts.append(page_name(page["title"]))
         id_to_path[page["id"]] = os.path.join(base, *parts)
     return id_to_path
 
@@ -133,7 +256,12 @@ def build_page_paths(pages: list) -> dict:
 # Confluence API helpers
 # ---------------------------------------------------------------------------
 
-def find_archive_page_ids(session: requests.Session) -> set:
+# Largest page size Confluence accepts for content search. The server may
+# still apply a lower cap (it does for some expansions), so loops compare
+# against the "limit" echoed in each response rather than the one requested.
+SEARCH_LIMIT = 200
+
+async def find_archive_page_ids(session: aiohttp.ClientSession) -> set:
     """Return IDs of pages whose titles match ARCHIVE_PAGE_TITLES."""
     if not ARCHIVE_PAGE_TITLES:
         return set()
@@ -143,28 +271,30 @@ def find_archive_page_ids(session: requests.Session) -> set:
     cql = f'space = "{SPACE_KEY}" AND type = page AND title in ({titles_cql})'
 
     ids = set()
-    limit = 50
+    # Titles are unique within a space, so this is normally a single request
+    limit = min(len(ARCHIVE_PAGE_TITLES) * 2, SEARCH_LIMIT)
     start = 0
     url = f"{BASE_URL}/rest/api/content/search"
 
     while True:
-        resp = session.get(url, params={"cql": cql, "limit": limit, "start": start}, timeout=REQUEST_TIMEOUT)
-        resp.raise_for_status()
-        results = resp.json().get("results", [])
+        async with _get(session, url, params={"cql": cql, "limit": limit, "start": start}) as resp:
+            resp.raise_for_status()
+            data = await resp.json()
+        results = data.get("results", [])
         for page in results:
             ids.add(page["id"])
             logging.info("Archive root found: '%s' (id=%s)", page["title"], page["id"])
-        if len(results) < limit:
+        if len(results) < data.get("limit", limit):
             break
-        start += limit
+        start += len(results)
 
     return ids
 
 
-def get_all_pages(session: requests.Session, archive_ids: set) -> list:
+async def get_all_pages(session: aiohttp.ClientSession, archive_ids: set) -> list:
     """Fetch every non-archived page in the space using CQL, handling pagination."""
     pages = []
-    limit = 50
+    limit = SEARCH_LIMIT
     start = 0
 
     # Base CQL: all pages in this space
@@ -186,38 +316,103 @@ def get_all_pages(session: requests.Session, archive_ids: set) -> list:
     url = f"{BASE_URL}/rest/api/content/search"
 
     while True:
-        resp = session.get(url, params={"cql": cql, "limit": limit, "start": start, "expand": "ancestors"}, timeout=REQUEST_TIMEOUT)
-        resp.raise_for_status()
-
-        results = resp.json().get("results", [])
+        params = {"cql": cql, "limit": limit, "start": start, "expand": "ancestors"}
+        async with _get(session, url, params=params) as resp:
+            resp.raise_for_status()
+            data = await resp.json()
+        results = data.get("results", [])
         pages.extend(results)
 
         logging.debug("Fetched %d pages (start=%d)", len(results), start)
 
-        if len(results) < limit:
+        if len(results) < data.get("limit", limit):
             break
-        start += limit
+        start += len(results)
 
     logging.info("Total pages found: %d", len(pages))
     return pages
 
 
-def export_page_content(session: requests.Session, page_id: str, title: str, page_dir: str):
-    """Download the HTML export view of a page and save it."""
+def _conditional_headers(validator: dict) -> dict:
+    """Build If-None-Match / If-Modified-Since headers from a stored validator."""
+    headers = {}
+    if validator:
+        if validator.get("etag"):
+            headers["If-None-Match"] = validator["etag"]
+        if validator.get("last_modified"):
+            headers["If-Modified-Since"] = validator["last_modified"]
+    return headers
+
+
+def _response_validator(resp: aiohttp.ClientResponse) -> dict:
+    """Extract the ETag / Last-Modified headers worth storing from a response."""
+    validator = {}
+    if resp.headers.get("ETag"):
+        validator["etag"] = resp.headers["ETag"]
+    if resp.headers.get("Last-Modified"):
+        validator["last_modified"] = resp.headers["Last-Modified"]
+    return validator
+
+
+async def export_page_content(
+    session: aiohttp.ClientSession,
+    page_id: str,
+    title: str,
+    page_dir: str,
+    validators: dict,
+    new_validators: dict,
+) -> bool:
+    """Download the HTML export view of a page and save it.
+
+    If a validator from a previous export is known and the file is still on
+    disk, the request is conditional. Returns False when Confluence answers
+    304 Not Modified and nothing was written.
+    """
     url = f"{BASE_URL}/rest/api/content/{page_id}"
     params = {"expand": "body.export_view"}
-    resp = session.get(url, params=params, timeout=REQUEST_TIMEOUT)
-    resp.raise_for_status()
-
-    html = resp.json()["body"]["export_view"]["value"]
     html_path = os.path.join(page_dir, safe_name(title) + ".html")
-    with open(html_path, "w", encoding="utf-8") as f:
-        f.write(html)
+    headers = _conditional_headers(validators.get(page_id)) if os.path.exists(html_path) else {}
+
+    async with _get(session, url, params=params, headers=headers) as resp:
+        if resp.status == 304:
+            logging.debug("Unchanged HTML: %s", html_path)
+            return False
+        resp.raise_for_status()
+        html = (await resp.json())["body"]["export_view"]["value"]
+        validator = _response_validator(resp)
+
+    async with aiofiles.open(html_path, "w", encoding="utf-8") as f:
+        await f.write(html)
+    if validator:
+        new_validators[page_id] = validator
     logging.debug("Saved HTML: %s", html_path)
+    return True
+
+
+# Attachment data is written in blocks of at least 1 MiB. Chunk sizes tuned
+# for the old requests.iter_content() loop (a few KiB) are far too small once
+# every write is offloaded to a thread.
+ATTACHMENT_WRITE_SIZE = max(ATTACHMENT_CHUNK_SIZE, 1024 * 1024)
+
+
+# Attachment filters normalized once; str.startswith accepts a tuple of prefixes
+_EXCLUDE_MIME_PREFIXES = tuple(EXCLUDE_ATTACHMENT_MIME_PREFIXES or ())
+_EXCLUDE_EXTENSIONS = frozenset(e.lower() for e in EXCLUDE_ATTACHMENT_EXTENSIONS or ())
+
 
+async def download_attachments(
+    session: aiohttp.ClientSession,
+    page_id: str,
+    page_dir: str,
+    validators: dict,
+    new_validators: dict,
+):
+    """Download all attachments for a page, with pagination and resume support.
 
-def download_attachments(session: requests.Session, page_id: str, page_dir: str):
-    """Download all attachments for a page, with pagination and resume support."""
+    Attachments already on disk are skipped, unless a validator from a
+    previous export is known, in which case they are re-fetched with a
+    conditional request and replaced only if Confluence reports a change.
+    """
     att_dir = os.path.join(page_dir, "attachments")
     os.makedirs(att_dir, exist_ok=True)
 
@@ -227,38 +422,59 @@ def download_attachments(session: requests.Session, page_id: str, page_dir: str)
     while True:
         url = f"{BASE_URL}/rest/api/content/{page_id}/child/attachment"
         params = {"limit": limit, "start": start}
-        resp = session.get(url, params=params, timeout=REQUEST_TIMEOUT)
-        resp.raise_for_status()
-
-        results = resp.json().get("results", [])
+        async with _get(session, url, params=params) as resp:
+            resp.raise_for_status()
+            results = (await resp.json()).get("results", [])
 
         for att in results:
-            filename = _UNSAFE_CHARS.sub("_", att["title"])
+            filename = att["title"].translate(_UNSAFE_TABLE)
             dest = os.path.join(att_dir, filename)
 
             media_type = att.get("metadata", {}).get("mediaType", "")
-            if EXCLUDE_ATTACHMENT_MIME_PREFIXES and any(media_type.startswith(p) for p in EXCLUDE_ATTACHMENT_MIME_PREFIXES):
+            if media_type.startswith(_EXCLUDE_MIME_PREFIXES):
                 logging.debug("Skipping attachment (type=%s): %s", media_type, filename)
                 continue
 
             ext = os.path.splitext(filename)[1].lower()
-            if EXCLUDE_ATTACHMENT_EXTENSIONS and ext in {e.lower() for e in EXCLUDE_ATTACHMENT_EXTENSIONS}:
+            if ext in _EXCLUDE_EXTENSIONS:
                 logging.debug("Skipping attachment (ext=%s): %s", ext, filename)
                 continue
 
+            att_id = att.get("id")
+            headers = {}
             if os.path.exists(dest):
-                logging.debug("Skipping existing attachment: %s", filename)
-                continue
+                headers = _conditional_headers(validators.get(att_id))
+                if not headers:
+                    logging.debug("Skipping existing attachment: %s", filename)
+                    continue
 
             download_path = att["_links"]["download"]
             file_url = f"{BASE_URL}{download_path}"
 
             logging.debug("Downloading attachment: %s", filename)
-            with session.get(file_url, stream=True, timeout=REQUEST_TIMEOUT) as dl:
+            async with _get(session, file_url, headers=headers) as dl:
+                if dl.status == 304:
+                    logging.debug("Unchanged attachment: %s", filename)
+                    continue
                 dl.raise_for_status()
-                with open(dest, "wb") as f:
-                    for chunk in dl.iter_content(chunk_size=ATTACHMENT_CHUNK_SIZE):
-                        f.write(chunk)
+                # Download beside the target and swap it in once complete, so
+                # an interrupted transfer never leaves a truncated file behind.
+                tmp = dest + ".part"
+                async with aiofiles.open(tmp, "wb") as f:
+                    # Each aiofiles write is a thread hop, so coalesce the
+                    # small network reads into large blocks before writing.
+                    buf = bytearray()
+                    async for data in dl.content.iter_any():
+                        buf += data
+                        if len(buf) >= ATTACHMENT_WRITE_SIZE:
+                            await f.write(buf)
+                            buf.clear()
+                    if buf:
+                        await f.write(buf)
+                os.replace(tmp, dest)
+                validator = _response_validator(dl)
+            if att_id and validator:
+                new_validators[att_id] = validator
             logging.debug("Saved attachment: %s", dest)
 
         if len(results) < limit:
@@ -269,38 +485,95 @@ def download_attachments(session: requests.Session, page_id: str, page_dir: str)
 # Per-page export orchestration
 # ---------------------------------------------------------------------------
 
-def export_page(session: requests.Session, page: dict, page_dir: str, progress: dict, index: int, total: int):
+async def export_page(
+    semaphore: asyncio.Semaphore,
+    session: aiohttp.ClientSession,
+    page: dict,
+    page_dir: str,
+    progress: dict,
+    index: int,
+    total: int,
+) -> bool:
+    """Export one page and its attachments, recording the outcome.
+
+    Returns True if Confluence reported the page body as unchanged since
+    the last export.
+    """
     page_id = page["id"]
     title = page["title"]
 
-    # Remove from failed so a retry is attempted cleanly
-    progress["failed"].pop(page_id, None)
+    async with semaphore:
+        # Remove from failed so a retry is attempted cleanly
+        progress["failed"].pop(page_id, None)
 
-    logging.info("[%d/%d] Exporting: %s (id=%s)", index, total, title, page_id)
+        logging.info("[%d/%d] Exporting: %s (id=%s)", index, total, title, page_id)
 
-    try:
-        os.makedirs(page_dir, exist_ok=True)
+        try:
+            os.makedirs(page_dir, exist_ok=True)
 
-        export_page_content(session, page_id, title, page_dir)
-        download_attachments(session, page_id, page_dir)
+            validators = {}
+            changed = await export_page_content(session, page_id, title, page_dir, progress["validators"], validators)
+            await download_attachments(session, page_id, page_dir, progress["validators"], validators)
 
-        progress["completed"].add(page_id)
-        save_progress(progress)
-        logging.debug("Completed page id=%s", page_id)
+            progress["completed"].add(page_id)
+            progress["validators"].update(validators)
+            await save_progress(progress, page_id, validators)
+            logging.debug("Completed page id=%s", page_id)
+            return not changed
 
-    except Exception as exc:
-        msg = f"{type(exc).__name__}: {exc}"
-        logging.warning("Failed page id=%s title=%r — %s", page_id, title, msg)
-        progress["failed"][page_id] = msg
-        save_progress(progress)
+        except Exception as exc:
+            msg = f"{type(exc).__name__}: {exc}"
+            logging.warning("Failed page id=%s title=%r — %s", page_id, title, msg)
+            # A completed page may fail revalidation; record it as failed only
+            progress["completed"].discard(page_id)
+            progress["failed"][page_id] = msg
+            await save_progress(progress, page_id)
+            return False
 
 # ---------------------------------------------------------------------------
 # Main entry point
 # ---------------------------------------------------------------------------
 
+async def run_all(progress: dict) -> tuple:
+    """Discover pages and export every page not yet completed.
+
+    Completed pages with a stored cache validator are revalidated with a
+    conditional request instead of being skipped, so changes made in
+    Confluence since the last run are picked up.
+
+    Returns (pages exported, pages unchanged, pages skipped as already completed).
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_PAGES)
+
+    async with make_session() as session:
+        try:
+            archive_ids = await find_archive_page_ids(session)
+            pages = await get_all_pages(session, archive_ids)
+        except Exception as exc:
+            logging.error("Failed to fetch page list: %s", exc)
+            sys.exit(1)
+
+        total = len(pages)
+        page_paths = build_page_paths(pages)
+        skipped = 0
+        tasks = []
+
+        for i, page in enumerate(pages, start=1):
+            page_id = page["id"]
+            if page_id in progress["completed"] and page_id not in progress["validators"]:
+                skipped += 1
+                logging.debug("Skipping completed page id=%s", page_id)
+                continue
+
+            tasks.append(export_page(semaphore, session, page, page_paths[page_id], progress, i, total))
+
+        unchanged = sum(await asyncio.gather(*tasks))
+
+    return len(tasks) - unchanged, unchanged, skipped
+
+
 def main():
     setup_logging()
-    session = make_session()
     progress = load_progress()
 
     already_done = len(progress["completed"])
@@ -308,31 +581,15 @@ def main():
         logging.info("Resuming: %d pages already completed.", already_done)
 
     try:
-        archive_ids = find_archive_page_ids(session)
-        pages = get_all_pages(session, archive_ids)
-    except Exception as exc:
-        logging.error("Failed to fetch page list: %s", exc)
-        sys.exit(1)
-
-    total = len(pages)
-    page_paths = build_page_paths(pages)
-    skipped = 0
-    exported = 0
-
-    for i, page in enumerate(pages, start=1):
-        page_id = page["id"]
-        if page_id in progress["completed"]:
-            skipped += 1
-            logging.debug("Skipping completed page id=%s", page_id)
-            continue
-
-        export_page(session, page, page_paths[page_id], progress, i, total)
-        exported += 1
+        exported, unchanged, skipped = asyncio.run(run_all(progress))
+    finally:
+        compact_progress(progress)
 
     # Summary
     failed_count = len(progress["failed"])
     logging.info("--- Export complete ---")
     logging.info("  Exported : %d", exported)
+    logging.info("  Unchanged: %d (not modified since last export)", unchanged)
     logging.info("  Skipped  : %d (already done)", skipped)
     logging.info("  Failed   : %d", failed_count)
 
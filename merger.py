@@ -11,12 +11,18 @@ import logging
 import os
 import re
 import sys
+from concurrent.futures import ProcessPoolExecutor
 
-from bs4 import BeautifulSoup
+from selectolax.lexbor import LexborHTMLParser
 
 from config import EXPORT_DIR, MAX_FILE_SIZE_BYTES
+from sections import collect_sections, convert_section
 
 UPLOAD_DIR = os.path.join("upload", "txt")
+CACHE_DIR = os.path.join("upload", ".merge_cache", "txt")
+
+# Bump whenever the conversion output changes so stale cache entries are discarded
+_CACHE_VERSION = 3
 
 # ---------------------------------------------------------------------------
 # Logging setup
@@ -41,55 +47,32 @@ def setup_logging():
 _WHITESPACE = re.compile(r"\n{3,}")
 
 
-def html_to_text(html: str) -> str:
+def html_to_text(html: bytes) -> str:
     """Strip HTML tags and collapse excessive whitespace."""
-    soup = BeautifulSoup(html, "html.parser")
-    text = soup.get_text(separator="\n")
+    # Only raw text is needed, so skip the BeautifulSoup tree and let the
+    # C-based lexbor parser extract it directly. Only <body> is read; the
+    # parser synthesizes one for bare export_view fragments.
+    body = LexborHTMLParser(html).body
+    # BeautifulSoup's get_text() never included script/style contents; keep it that way
+    body.strip_tags(["script", "style"])
+    text = body.text(separator="\n")
     # Collapse 3+ consecutive newlines to 2
     text = _WHITESPACE.sub("\n\n", text)
     return text.strip()
 
+
 # ---------------------------------------------------------------------------
-# Section collection
+# Merging
 # ---------------------------------------------------------------------------
 
-def collect_sections(export_dir: str) -> dict:
-    """Return a dict mapping section_name -> list of (page_title, html_path).
+_SEPARATOR = b"\n\n"
+_SEPARATOR_SIZE = len(_SEPARATOR)
 
-    Sections are the immediate subdirectories of export_dir.
-    Pages within each section are collected recursively and sorted by path
-    so that parent pages appear before their children.
-    """
-    sections = {}
-    # Strip extended-length prefix if present for os.scandir compatibility
-    scan_dir = export_dir.lstrip("\\\\?\\")
-
-    if not os.path.isdir(scan_dir):
-        logging.error("Export directory not found: %s", scan_dir)
-        return sections
-
-    for entry in sorted(os.scandir(scan_dir), key=lambda e: e.name):
-        if not entry.is_dir():
-            continue
-        section_name = entry.name
-        html_files = []
-        for root, _dirs, files in os.walk(entry.path):
-            for fname in sorted(files):
-                if fname.endswith(".html"):
-                    page_title = os.path.splitext(fname)[0]
-                    html_files.append((page_title, os.path.join(root, fname)))
-        if html_files:
-            sections[section_name] = html_files
-            logging.debug("Section '%s': %d pages", section_name, len(html_files))
-
-    return sections
 
-# ---------------------------------------------------------------------------
-# Merging
-# ---------------------------------------------------------------------------
+def merge_section(section_name: str, converted, output_dir: str):
+    """Merge a section's converted pages into one or more .txt files.
 
-def merge_section(section_name: str, html_files: list, output_dir: str):
-    """Convert and merge all pages in a section into one or more .txt files.
+    converted is the iterator returned by convert_section().
 
     Files are split at page boundaries when MAX_FILE_SIZE_BYTES would be exceeded.
     Parts are named <section>.txt, <section>_part2.txt, <section>_part3.txt, …
@@ -100,54 +83,48 @@ def merge_section(section_name: str, html_files: list, output_dir: str):
         suffix = "" if part == 1 else f"_part{part}"
         return os.path.join(output_dir, f"{section_name}{suffix}.txt")
 
-    part = 1
-    current_parts = []
+    # Pages are written as soon as they are converted, so the output is never
+    # joined in memory; the file is rolled over at page boundaries. The
+    # section's converted text is still kept for the cache rewrite, so memory
+    # grows with the largest section (plus the one queued behind it).
+    out_f = None
+    part = 0
     current_size = 0
-    files_written = 0
+    page_count = 0
 
-    def _flush(parts: list, p: int, page_count: int):
-        content = "\n\n".join(parts)
-        path = _out_path(p)
-        with open(path, "w", encoding="utf-8") as f:
-            f.write(content)
-        logging.info("Written: %s (%d pages, %d bytes)", path, page_count, len(content.encode("utf-8")))
+    def _close():
+        out_f.close()
+        logging.info("Written: %s (%d pages, %d bytes)", out_f.name, page_count, current_size)
 
-    page_count = 0
-    for page_title, html_path in html_files:
-        try:
-            with open(html_path, "r", encoding="utf-8") as f:
-                html = f.read()
-            text = html_to_text(html)
-            logging.debug("Converted: %s", html_path)
-        except Exception as exc:
-            logging.warning("Failed to convert %s — %s", html_path, exc)
-            continue
-
-        entry = f"=== Page: {page_title} ===\n\n{text}"
-        entry_size = len(entry.encode("utf-8"))
-        separator_size = len("\n\n".encode("utf-8")) if current_parts else 0
-
-        if current_parts and (current_size + separator_size + entry_size) > MAX_FILE_SIZE_BYTES:
-            _flush(current_parts, part, page_count)
-            files_written += 1
+    for page_title, text in converted:
+        # Encoded once: the bytes are both measured and written
+        entry = f"=== Page: {page_title} ===\n\n{text}".encode("utf-8")
+        entry_size = len(entry)
+
+        if out_f is not None and (current_size + _SEPARATOR_SIZE + entry_size) > MAX_FILE_SIZE_BYTES:
+            _close()
+            out_f = None
+
+        if out_f is None:
             part += 1
-            current_parts = []
+            out_f = open(_out_path(part), "wb")
             current_size = 0
             page_count = 0
-
-        if not current_parts and entry_size > MAX_FILE_SIZE_BYTES:
-            logging.warning("Page '%s' exceeds MAX_FILE_SIZE_BYTES (%d bytes) — written alone", page_title, entry_size)
-
-        current_parts.append(entry)
-        current_size += entry_size + separator_size
+            if entry_size > MAX_FILE_SIZE_BYTES:
+                logging.warning("Page '%s' exceeds MAX_FILE_SIZE_BYTES (%d bytes) — written alone", page_title, entry_size)
+        else:
+            out_f.write(_SEPARATOR)
+            current_size += _SEPARATOR_SIZE
+
+        out_f.write(entry)
+        current_size += entry_size
         page_count += 1
 
-    if current_parts:
-        _flush(current_parts, part, page_count)
-        files_written += 1
+    if out_f is not None:
+        _close()
 
-    if files_written > 1:
-        logging.info("Section '%s' split into %d files.", section_name, files_written)
+    if part > 1:
+        logging.info("Section '%s' split into %d files.", section_name, part)
 
 # ---------------------------------------------------------------------------
 # Main
@@ -168,8 +145,19 @@ def main():
 
     logging.info("Found %d top-level section(s). Writing to %s ...", len(sections), UPLOAD_DIR)
 
-    for section_name, html_files in sections.items():
-        merge_section(section_name, html_files, UPLOAD_DIR)
+    with ProcessPoolExecutor() as executor:
+        def _start(name: str):
+            return convert_section(name, sections[name], executor, html_to_text, CACHE_DIR, _CACHE_VERSION)
+
+        # Queue the next section's conversions before merging the current one
+        # so the workers never sit idle while the parent writes output.
+        names = list(sections)
+        pending = _start(names[0])
+        for i, section_name in enumerate(names):
+            converted = pending
+            if i + 1 < len(names):
+                pending = _start(names[i + 1])
+            merge_section(section_name, converted, UPLOAD_DIR)
 
     logging.info("--- Done. %d file(s) written to %s ---", len(sections), UPLOAD_DIR)
 
@@ -11,12 +11,18 @@ import logging
 import os
 import re
 import sys
+from concurrent.futures import ProcessPoolExecutor
 
 from bs4 import BeautifulSoup, Tag
 
 from config import EXPORT_DIR, MAX_FILE_SIZE_BYTES
+from sections import collect_sections, convert_section
 
 UPLOAD_DIR = os.path.join("upload", "md")
+CACHE_DIR = os.path.join("upload", ".merge_cache", "md")
+
+# Bump whenever the conversion output changes so stale cache entries are discarded
+_CACHE_VERSION = 1
 
 # ---------------------------------------------------------------------------
 # Logging setup
@@ -45,111 +51,137 @@ _WHITESPACE = re.compile(r"\n{3,}")
 _HEADING_MAP = {"h1": "###", "h2": "###", "h3": "####", "h4": "#####", "h5": "#####", "h6": "#####"}
 
 
-def _convert_node(node) -> str:
-    """Recursively convert a BeautifulSoup node to Markdown text."""
-    if isinstance(node, str):
-        return node
+def _heading(node) -> str:
+    text = node.get_text(" ", strip=True)
+    return f"\n{_HEADING_MAP[node.name.lower()]} {text}\n"
+
+
+def _paragraph(node) -> str:
+    text = node.get_text(" ", strip=True)
+    return f"\n{text}\n" if text else ""
+
+
+def _list(node) -> str:
+    items = []
+    for li in node.find_all("li", recursive=False):
+        items.append(f"- {li.get_text(' ', strip=True)}")
+    return "\n" + "\n".join(items) + "\n" if items else ""
+
+
+def _line_break(node) -> str:
+    return "\n"
+
+
+def _bold(node) -> str:
+    text = node.get_text(" ", strip=True)
+    return f"**{text}**" if text else ""
+
+
+def _italic(node) -> str:
+    text = node.get_text(" ", strip=True)
+    return f"*{text}*" if text else ""
+
+
+def _code(node) -> str:
+    text = node.get_text("", strip=True)
+    return f"`{text}`" if text else ""
+
+
+def _preformatted(node) -> str:
+    text = node.get_text("", strip=False)
+    return f"\n```\n{text}\n```\n"
 
-    if not isinstance(node, Tag):
-        return ""
 
-    tag = node.name.lower() if node.name else ""
+def _link(node) -> str:
+    text = node.get_text(" ", strip=True)
+    href = node.get("href", "")
+    return f"[{text}]({href})" if text else ""
 
-    if tag in _HEADING_MAP:
-        text = node.get_text(" ", strip=True)
-        return f"\n{_HEADING_MAP[tag]} {text}\n"
 
-    if tag == "p":
-        text = node.get_text(" ", strip=True)
-        return f"\n{text}\n" if text else ""
+def _table(node) -> str:
+    # Flatten tables to plain text rows
+    rows = []
+    for row in node.find_all("tr"):
+        cells = [cell.get_text(" ", strip=True) for cell in row.find_all(["td", "th"])]
+        rows.append(" | ".join(cells))
+    return "\n" + "\n".join(rows) + "\n" if rows else ""
 
-    if tag in ("ul", "ol"):
-        items = []
-        for li in node.find_all("li", recursive=False):
-            items.append(f"- {li.get_text(' ', strip=True)}")
-        return "\n" + "\n".join(items) + "\n" if items else ""
 
-    if tag == "br":
-        return "\n"
+def _skip(node) -> str:
+    return ""
 
-    if tag in ("strong", "b"):
-        text = node.get_text(" ", strip=True)
-        return f"**{text}**" if text else ""
 
-    if tag in ("em", "i"):
-        text = node.get_text(" ", strip=True)
-        return f"*{text}*" if text else ""
+# Tags converted as a unit; any tag not listed here is transparent and its
+# children are converted in its place.
+_TAG_HANDLERS = {
+    **{tag: _heading for tag in _HEADING_MAP},
+    "p": _paragraph,
+    "ul": _list,
+    "ol": _list,
+    "br": _line_break,
+    "strong": _bold,
+    "b": _bold,
+    "em": _italic,
+    "i": _italic,
+    "code": _code,
+    "pre": _preformatted,
+    "a": _link,
+    "table": _table,
+    "script": _skip,
+    "style": _skip,
+    "head": _skip,
+}
 
-    if tag == "code":
-        text = node.get_text("", strip=True)
-        return f"`{text}`" if text else ""
 
-    if tag == "pre":
-        text = node.get_text("", strip=False)
-        return f"\n```\n{text}\n```\n"
+def _convert_node(root) -> str:
+    """Convert a BeautifulSoup node to Markdown text.
 
-    if tag == "a":
-        text = node.get_text(" ", strip=True)
-        href = node.get("href", "")
-        return f"[{text}]({href})" if text else ""
+    Walks the tree with an explicit stack rather than recursion, collecting
+    output fragments in a list that is joined once at the end.
+    """
+    out = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+
+        if isinstance(node, str):
+            out.append(node)
+            continue
 
-    if tag == "table":
-        # Flatten tables to plain text rows
-        rows = []
-        for row in node.find_all("tr"):
-            cells = [cell.get_text(" ", strip=True) for cell in row.find_all(["td", "th"])]
-            rows.append(" | ".join(cells))
-        return "\n" + "\n".join(rows) + "\n" if rows else ""
+        if not isinstance(node, Tag):
+            continue
 
-    if tag in ("script", "style", "head"):
-        return ""
+        tag = node.name.lower() if node.name else ""
+        handler = _TAG_HANDLERS.get(tag)
+        if handler is not None:
+            out.append(handler(node))
+        else:
+            # Push children reversed so they are popped in document order
+            stack.extend(reversed(node.contents))
 
-    # For all other tags, recurse into children
-    return "".join(_convert_node(child) for child in node.children)
+    return "".join(out)
 
 
-def html_to_markdown(html: str) -> str:
+def html_to_markdown(html: bytes) -> str:
     """Convert HTML to Markdown, preserving basic structure."""
-    soup = BeautifulSoup(html, "html.parser")
+    soup = BeautifulSoup(html, "lxml", from_encoding="utf-8")
     md = _convert_node(soup)
     md = _WHITESPACE.sub("\n\n", md)
     return md.strip()
 
+
 # ---------------------------------------------------------------------------
-# Section collection (identical logic to merger.py)
+# Merging
 # ---------------------------------------------------------------------------
 
-def collect_sections(export_dir: str) -> dict:
-    """Return a dict mapping section_name -> list of (page_title, html_path)."""
-    sections = {}
-    scan_dir = export_dir.lstrip("\\\\?\\")
+_SEPARATOR = b"\n\n"
+_SEPARATOR_SIZE = len(_SEPARATOR)
 
-    if not os.path.isdir(scan_dir):
-        logging.error("Export directory not found: %s", scan_dir)
-        return sections
 
-    for entry in sorted(os.scandir(scan_dir), key=lambda e: e.name):
-        if not entry.is_dir():
-            continue
-        section_name = entry.name
-        html_files = []
-        for root, _dirs, files in os.walk(entry.path):
-            for fname in sorted(files):
-                if fname.endswith(".html"):
-                    page_title = os.path.splitext(fname)[0]
-                    html_files.append((page_title, os.path.join(root, fname)))
-        if html_files:
-            sections[section_name] = html_files
-            logging.debug("Section '%s': %d pages", section_name, len(html_files))
-
-    return sections
+def merge_section(section_name: str, converted, output_dir: str):
+    """Merge a section's converted pages into one or more .md files.
 
-# ---------------------------------------------------------------------------
-# Merging
-# ---------------------------------------------------------------------------
-
-def merge_section(section_name: str, html_files: list, output_dir: str):
-    """Convert and merge all pages in a section into one or more .md files.
+    converted is the iterator returned by convert_section().
 
     Files are split at page boundaries when MAX_FILE_SIZE_BYTES would be exceeded.
     Parts are named <section>.md, <section>_part2.md, <section>_part3.md, …
@@ -161,57 +193,50 @@ def merge_section(section_name: str, html_files: list, output_dir: str):
         suffix = "" if part == 1 else f"_part{part}"
         return os.path.join(output_dir, f"{section_name}{suffix}.md")
 
-    header = f"# {section_name}\n"
-    header_size = len(header.encode("utf-8"))
+    header = f"# {section_name}\n".encode("utf-8")
+    header_size = len(header)
 
-    part = 1
-    current_parts = [header]
-    current_size = header_size
-    files_written = 0
+    # Pages are written as soon as they are converted, so the output is never
+    # joined in memory; the file is rolled over at page boundaries. The
+    # section's converted text is still kept for the cache rewrite, so memory
+    # grows with the largest section (plus the one queued behind it).
+    out_f = None
+    part = 0
+    current_size = 0
+    page_count = 0
 
-    def _flush(parts: list, p: int, page_count: int):
-        content = "\n\n".join(parts)
-        path = _out_path(p)
-        with open(path, "w", encoding="utf-8") as f:
-            f.write(content)
-        logging.info("Written: %s (%d pages, %d bytes)", path, page_count, len(content.encode("utf-8")))
+    def _close():
+        out_f.close()
+        logging.info("Written: %s (%d pages, %d bytes)", out_f.name, page_count, current_size)
 
-    page_count = 0
-    for page_title, html_path in html_files:
-        try:
-            with open(html_path, "r", encoding="utf-8") as f:
-                html = f.read()
-            md = html_to_markdown(html)
-            logging.debug("Converted: %s", html_path)
-        except Exception as exc:
-            logging.warning("Failed to convert %s — %s", html_path, exc)
-            continue
+    for page_title, md in converted:
+        # Encoded once: the bytes are both measured and written
+        entry = f"## {page_title}\n\n{md}".encode("utf-8")
+        entry_size = len(entry)
 
-        entry = f"## {page_title}\n\n{md}"
-        entry_size = len(entry.encode("utf-8"))
-        separator_size = len("\n\n".encode("utf-8"))
+        if out_f is not None and (current_size + _SEPARATOR_SIZE + entry_size) > MAX_FILE_SIZE_BYTES:
+            _close()
+            out_f = None
 
-        if page_count > 0 and (current_size + separator_size + entry_size) > MAX_FILE_SIZE_BYTES:
-            _flush(current_parts, part, page_count)
-            files_written += 1
+        if out_f is None:
             part += 1
-            current_parts = [header]
+            out_f = open(_out_path(part), "wb")
+            out_f.write(header)
             current_size = header_size
             page_count = 0
+            if (header_size + _SEPARATOR_SIZE + entry_size) > MAX_FILE_SIZE_BYTES:
+                logging.warning("Page '%s' exceeds MAX_FILE_SIZE_BYTES (%d bytes) — written alone", page_title, entry_size)
 
-        if page_count == 0 and (header_size + separator_size + entry_size) > MAX_FILE_SIZE_BYTES:
-            logging.warning("Page '%s' exceeds MAX_FILE_SIZE_BYTES (%d bytes) — written alone", page_title, entry_size)
-
-        current_parts.append(entry)
-        current_size += separator_size + entry_size
+        out_f.write(_SEPARATOR)
+        out_f.write(entry)
+        current_size += _SEPARATOR_SIZE + entry_size
         page_count += 1
 
-    if page_count > 0:
-        _flush(current_parts, part, page_count)
-        files_written += 1
+    if out_f is not None:
+        _close()
 
-    if files_written > 1:
-        logging.info("Section '%s' split into %d files.", section_name, files_written)
+    if part > 1:
+        logging.info("Section '%s' split into %d files.", section_name, part)
 
 # ---------------------------------------------------------------------------
 # Main
@@ -231,8 +256,19 @@ def main():
 
     logging.info("Found %d top-level section(s). Writing to %s ...", len(sections), UPLOAD_DIR)
 
-    for section_name, html_files in sections.items():
-        merge_section(section_name, html_files, UPLOAD_DIR)
+    with ProcessPoolExecutor() as executor:
+        def _start(name: str):
+            return convert_section(name, sections[name], executor, html_to_markdown, CACHE_DIR, _CACHE_VERSION)
+
+        # Queue the next section's conversions before merging the current one
+        # so the workers never sit idle while the parent writes output.
+        names = list(sections)
+        pending = _start(names[0])
+        for i, section_name in enumerate(names):
+            converted = pending
+            if i + 1 < len(names):
+                pending = _start(names[i + 1])
+            merge_section(section_name, converted, UPLOAD_DIR)
 
     logging.info("--- Done. %d file(s) written to %s ---", len(sections), UPLOAD_DIR)
 
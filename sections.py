@@ -0,0 +1,180 @@
+"""sections.py — Locate and convert exported pages for the merger scripts.
+
+Shared by merger.py and merger_md.py so both see the export directory the
+same way and share the conversion cache and worker pool plumbing; each
+merger supplies only its converter and cache settings.
+"""
+
+import functools
+import logging
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+_EXTENDED_PREFIX = "\\\\?\\"
+
+
+def _iter_html_files(path: str):
+    """Yield (page_title, html_path) for every .html file beneath path.
+
+    Each directory is listed once with os.scandir, whose DirEntry objects
+    carry the file type from the listing itself, so no extra stat calls are
+    made. Files are yielded before descending into subdirectories, and both
+    are taken in name order, so a parent page always precedes its children.
+    """
+    try:
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda e: e.name)
+    except OSError as exc:
+        # Unreadable directories are skipped, as os.walk did before
+        logging.warning("Skipping unreadable directory %s — %s", path, exc)
+        return
+
+    subdirs = []
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            subdirs.append(entry.path)
+        elif entry.name.endswith(".html"):
+            yield os.path.splitext(entry.name)[0], entry.path
+
+    for subdir in subdirs:
+        yield from _iter_html_files(subdir)
+
+
+def collect_sections(export_dir: str) -> dict:
+    """Return a dict mapping section_name -> list of (page_title, html_path).
+
+    Sections are the immediate subdirectories of export_dir.
+    Pages within each section are collected recursively and ordered so
+    that parent pages appear before their children.
+    """
+    sections = {}
+    # Strip extended-length prefix if present for os.scandir compatibility
+    scan_dir = export_dir
+    if scan_dir.startswith(_EXTENDED_PREFIX):
+        scan_dir = scan_dir[len(_EXTENDED_PREFIX):]
+
+    if not os.path.isdir(scan_dir):
+        logging.error("Export directory not found: %s", scan_dir)
+        return sections
+
+    with os.scandir(scan_dir) as it:
+        entries = sorted(it, key=lambda e: e.name)
+
+    for entry in entries:
+        if not entry.is_dir():
+            continue
+        section_name = entry.name
+        html_files = list(_iter_html_files(entry.path))
+        if html_files:
+            sections[section_name] = html_files
+            logging.debug("Section '%s': %d pages", section_name, len(html_files))
+
+    return sections
+
+# ---------------------------------------------------------------------------
+# Conversion
+# ---------------------------------------------------------------------------
+
+def _convert_file(convert, html_path: str) -> tuple:
+    """Read and convert one page with convert(). Runs in a worker process.
+
+    Returns (converted, None) on success or (None, error message) on failure,
+    so one bad page does not abort the whole section.
+    """
+    try:
+        # Pass the raw bytes straight to the parser, which decodes them as
+        # it builds the tree, instead of materializing a decoded str first.
+        with open(html_path, "rb") as f:
+            html = f.read()
+        return convert(html), None
+    except Exception as exc:
+        return None, f"{type(exc).__name__}: {exc}"
+
+# ---------------------------------------------------------------------------
+# Conversion cache
+# ---------------------------------------------------------------------------
+
+def _cache_path(cache_dir: str, section_name: str) -> str:
+    return os.path.join(cache_dir, f"{section_name}.pickle")
+
+
+def load_cache(cache_dir: str, section_name: str, version: int) -> dict:
+    """Return the cached {html_path: ((mtime_ns, size), converted)} for a section."""
+    path = _cache_path(cache_dir, section_name)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "rb") as f:
+            cached_version, entries = pickle.load(f)
+    except Exception as exc:
+        logging.warning("Ignoring unreadable cache %s — %s", path, exc)
+        return {}
+    return entries if cached_version == version else {}
+
+
+def save_cache(cache_dir: str, section_name: str, version: int, entries: dict):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = _cache_path(cache_dir, section_name)
+    # Write to a temp file first, then rename for atomicity
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump((version, entries), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+
+def convert_section(
+    section_name: str,
+    html_files: list,
+    executor: ProcessPoolExecutor,
+    convert,
+    cache_dir: str,
+    version: int,
+):
+    """Start converting a section and return an iterator over the results.
+
+    convert is the merger's module-level bytes -> str converter; cache_dir
+    and version identify its cache. Pages whose mtime and size match the
+    section cache are served from it; the rest are queued on the worker pool
+    immediately, so the workers can read and parse them while the caller is
+    still writing out an earlier section. The iterator yields
+    (page_title, converted) in input order, skipping failed pages, and
+    rewrites the cache once fully consumed.
+    """
+    cache = load_cache(cache_dir, section_name, version)
+    lookups = []
+    for page_title, html_path in html_files:
+        try:
+            st = os.stat(html_path)
+        except OSError as exc:
+            logging.warning("Failed to convert %s — %s", html_path, exc)
+            continue
+        key = (st.st_mtime_ns, st.st_size)
+        cached = cache.get(html_path)
+        lookups.append((page_title, html_path, key, cached[1] if cached and cached[0] == key else None))
+
+    # Parsing is CPU-bound, so cache misses are converted in worker processes;
+    # map() yields results in input order, keeping the split logic sequential.
+    misses = [html_path for _title, html_path, _key, converted in lookups if converted is None]
+    results = executor.map(functools.partial(_convert_file, convert), misses, chunksize=8)
+    return _iter_results(cache_dir, section_name, version, lookups, results)
+
+
+def _iter_results(cache_dir: str, section_name: str, version: int, lookups: list, results):
+    entries = {}
+    hits = 0
+    for page_title, html_path, key, converted in lookups:
+        if converted is None:
+            converted, error = next(results)
+            if error is not None:
+                logging.warning("Failed to convert %s — %s", html_path, error)
+                continue
+            logging.debug("Converted: %s", html_path)
+        else:
+            logging.debug("Cached: %s", html_path)
+            hits += 1
+        entries[html_path] = (key, converted)
+        yield page_title, converted
+
+    save_cache(cache_dir, section_name, version, entries)
+    logging.debug("Section '%s': %d of %d pages served from cache", section_name, hits, len(lookups))